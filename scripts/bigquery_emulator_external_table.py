@@ -2,26 +2,91 @@
 """
 BigQuery External Table with Emulator
 
-This script uses the BigQuery emulator from docker-compose to create external tables,
-load data, and query the results.
+This script runs the BigQuery emulator and file server from docker-compose.yml
+through the Docker SDK to create external tables, load data, and query the results.
 
 Usage:
     python3 bigquery_emulator_external_table.py <parquet_file_path>
 """
 
 import argparse
+import asyncio
+import concurrent.futures
 import json
-import subprocess
+import logging
+import os
+import re
 import sys
 import time
+import aiohttp
+import docker
+import orjson
 import requests
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Import our schema generator
 from parquet_to_bq_schema import generate_bigquery_schema_from_parquet
 
+# Directory mounted into the emulator and file server containers
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+# Project name `docker compose` uses, derived from the repository directory by default
+COMPOSE_PROJECT = os.environ.get("COMPOSE_PROJECT_NAME") or re.sub(r"[^a-z0-9_-]", "", DATA_DIR.parent.name.lower())
+# Network shared by the service containers
+NETWORK_NAME = f"{COMPOSE_PROJECT}_bigquery"
+
+# Rows decoded from the parquet file at a time when streaming inserts
+READ_BATCH_SIZE = 10_000
+# Rows per insertAll request; BigQuery recommends ~500 rows per request
+BATCH_SIZE = 500
+# insertAll requests in flight at once; gains flatten out past a handful
+CONCURRENCY = 4
+
+# Rows per query results page
+PAGE_SIZE = 1000
+
+# Table mode probed by --mode auto, keyed by emulator endpoint
+MODE_CACHE_FILE = Path.home() / ".bigquery_emulator_mode.json"
+
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _json_dumps(value) -> bytes:
+    """Serialize to JSON with orjson, falling back to str() for decimals, bytes and the like."""
+    return orjson.dumps(value, default=str)
+
+
+def _json_loads(response: requests.Response):
+    """Decode a JSON response body with orjson."""
+    return orjson.loads(response.content)
+
+
+def _run_sync(coro):
+    """Run a coroutine to completion from synchronous code, even inside a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    
+    # Called from a running loop (Jupyter, async apps): run on a private loop in a worker thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+class LoadJobFailed(Exception):
+    """The emulator rejected a load job or finished it with an error."""
+
+
+def _fields_from_tuples(column_tuples: List[Tuple[str, str]]) -> List[Dict]:
+    """Build BigQuery API schema fields from (column_name, datatype) tuples."""
+    return [{"name": name, "type": datatype, "mode": "NULLABLE"} for name, datatype in column_tuples]
+
 
 class BigQueryEmulatorExternalTable:
     """Creates external tables using BigQuery emulator."""
@@ -31,29 +96,118 @@ class BigQueryEmulatorExternalTable:
                  emulator_port: int = 9050,
                  file_server_port: int = 8080,
                  project_id: str = "test-project",
-                 dataset_id: str = "test_dataset"):
+                 dataset_id: str = "test_dataset",
+                 verify_files: bool = False):
         self.emulator_host = emulator_host
         self.emulator_port = emulator_port
         self.file_server_port = file_server_port
         self.project_id = project_id
         self.dataset_id = dataset_id
+        self.verify_files = verify_files
         self.base_url = f"http://{emulator_host}:{emulator_port}"
         
+        # Reuse keep-alive connections for every emulator and file server call
+        self.session = requests.Session()
+        # Give up retrying with the last response rather than RetryError, so callers
+        # still see and handle the status code themselves
+        retries = Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+        self.session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retries))
+        
+        # Dataset and table resources already fetched, keyed by URL
+        self._response_cache: Dict[str, Dict] = {}
+        
+        # Created on first use so the class works without a Docker daemon
+        self._docker_client = None
+        
+    @property
+    def docker_client(self) -> 'docker.DockerClient':
+        """Docker client talking to the daemon socket, shared by start and stop."""
+        if self._docker_client is None:
+            self._docker_client = docker.from_env()
+        return self._docker_client
+    
+    def _service_definitions(self) -> Dict[str, Dict]:
+        """Container settings for each service in docker-compose.yml, keyed by container name."""
+        data_dir = str(DATA_DIR)
+        return {
+            "bigquery-emulator": {
+                "image": "ghcr.io/goccy/bigquery-emulator:latest",
+                "platform": "linux/amd64",
+                "ports": {"9050/tcp": self.emulator_port, "9060/tcp": 9060},
+                "environment": {
+                    "PROJECT_ID": self.project_id,
+                    "DATASET_ID": self.dataset_id
+                },
+                "volumes": {data_dir: {"bind": "/data", "mode": "rw"}},
+                "command": [
+                    "--project", self.project_id,
+                    "--dataset", self.dataset_id,
+                    "--port", "9050",
+                    "--grpc-port", "9060",
+                    "--log-level", "info"
+                ],
+                # Durations are in nanoseconds
+                "healthcheck": {
+                    "test": ["CMD", "curl", "-f",
+                             f"http://localhost:9060/bigquery/v2/projects/{self.project_id}/datasets"],
+                    "interval": 30 * 10**9,
+                    "timeout": 10 * 10**9,
+                    "retries": 5,
+                    "start_period": 40 * 10**9
+                }
+            },
+            # simple file server to serve parquet files
+            "file-server": {
+                "image": "nginx:alpine",
+                "ports": {"80/tcp": self.file_server_port},
+                "environment": {"NGINX_PORT": "80"},
+                "volumes": {data_dir: {"bind": "/usr/share/nginx/html/data", "mode": "rw"}}
+            }
+        }
+    
+    def _service_containers(self) -> List['docker.models.containers.Container']:
+        """Containers of our services, whether started by this script or by `docker compose up`."""
+        containers = {}
+        for name in self._service_definitions():
+            try:
+                container = self.docker_client.containers.get(name)
+                containers[container.id] = container
+            except docker.errors.NotFound:
+                pass
+            
+            # Compose names its containers <project>-<service>-1, find them by label
+            labels = [f"com.docker.compose.project={COMPOSE_PROJECT}", f"com.docker.compose.service={name}"]
+            for container in self.docker_client.containers.list(all=True, filters={"label": labels}):
+                containers[container.id] = container
+        return list(containers.values())
+    
+    def _remove_services(self):
+        """Stop and remove the service containers and their network if they exist."""
+        # The emulator loses its datasets and tables with the container
+        self._response_cache.clear()
+        
+        for container in self._service_containers():
+            container.stop()
+            container.remove()
+        
+        try:
+            self.docker_client.networks.get(NETWORK_NAME).remove()
+        except docker.errors.NotFound:
+            pass
+    
     def start_services(self):
-        """Start BigQuery emulator and file server using docker-compose."""
+        """Start BigQuery emulator and file server containers."""
         print("Starting BigQuery emulator and file server...")
         
         try:
             # Stop any existing services
-            subprocess.run(['docker', 'compose', 'down'], 
-                         cwd='../', capture_output=True)
-            
-            # Start services
-            result = subprocess.run(['docker', 'compose', 'up', '-d'], 
-                                  cwd='../', capture_output=True, text=True)
+            self._remove_services()
             
-            if result.returncode != 0:
-                raise Exception(f"Failed to start services: {result.stderr}")
+            # Start services on a shared network, like compose does, so they can
+            # reach each other by name
+            self.docker_client.networks.create(NETWORK_NAME, driver="bridge")
+            for name, definition in self._service_definitions().items():
+                self.docker_client.containers.run(name=name, detach=True, network=NETWORK_NAME, **definition)
                 
             print("Services started successfully")
             
@@ -68,36 +222,45 @@ class BigQueryEmulatorExternalTable:
         print("Stopping services...")
         
         try:
-            subprocess.run(['docker', 'compose', 'down'], 
-                         cwd='../', capture_output=True)
+            self._remove_services()
             print("Services stopped")
         except Exception as e:
             print(f"Warning: Error stopping services: {e}")
+        finally:
+            self.session.close()
     
-    def _wait_for_services(self):
+    def _post_json(self, url: str, body: Dict) -> requests.Response:
+        """POST a JSON body encoded with orjson."""
+        return self.session.post(url, data=_json_dumps(body), headers=JSON_HEADERS)
+    
+    def _wait_for_services(self, timeout: float = 120):
         """Wait for BigQuery emulator and file server to be ready."""
         print("Waiting for services to be ready...")
         
-        max_retries = 60  # Increased timeout
-        retry_count = 0
-        
-        while retry_count < max_retries:
-            try:
-                # Check BigQuery emulator
-                bq_response = requests.get(f"{self.base_url}/bigquery/v2/projects")
-                
-                # Check file server
-                file_response = requests.get(f"http://{self.emulator_host}:{self.file_server_port}")
-                
-                if bq_response.status_code == 200 and file_response.status_code == 200:
-                    print("Services are ready!")
-                    return
+        # Back off exponentially so an emulator that is already up is seen quickly
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        
+        # Probe without the session's retries, each retry would add its own backoff
+        # and a not-yet-listening port should fail immediately
+        with requests.Session() as probe:
+            while time.monotonic() < deadline:
+                try:
+                    # Check BigQuery emulator (its routes only answer GET)
+                    bq_response = probe.get(f"{self.base_url}/bigquery/v2/projects")
                     
-            except requests.exceptions.ConnectionError:
-                pass
-            
-            retry_count += 1
-            time.sleep(2)
+                    # Check file server
+                    file_response = probe.head(f"http://{self.emulator_host}:{self.file_server_port}")
+                    
+                    if bq_response.status_code == 200 and file_response.status_code == 200:
+                        print("Services are ready!")
+                        return
+                        
+                except requests.exceptions.RequestException:
+                    pass
+                
+                time.sleep(delay)
+                delay = min(delay * 1.5, 2.0)
         
         raise Exception("Services failed to start within timeout period")
     
@@ -107,10 +270,15 @@ class BigQueryEmulatorExternalTable:
         
         # Check if dataset exists
         url = f"{self.base_url}/bigquery/v2/projects/{self.project_id}/datasets/{self.dataset_id}"
-        response = requests.get(url)
+        if url in self._response_cache:
+            print(f"Dataset {self.dataset_id} already exists")
+            return
+        
+        response = self.session.get(url)
         
         if response.status_code == 200:
             print(f"Dataset {self.dataset_id} already exists")
+            self._response_cache[url] = _json_loads(response)
             return
         
         # Create dataset
@@ -124,13 +292,32 @@ class BigQueryEmulatorExternalTable:
             "description": "Test dataset for external table demo"
         }
         
-        response = requests.post(create_url, json=dataset_data)
+        response = self._post_json(create_url, dataset_data)
         
         if response.status_code == 200:
             print(f"Created dataset {self.dataset_id}")
+            self._response_cache[url] = _json_loads(response)
         else:
             raise Exception(f"Failed to create dataset: {response.status_code} - {response.text}")
     
+    def _file_server_url(self, parquet_file: str) -> str:
+        """Get the URL the file server exposes the parquet file under."""
+        return f"http://{self.emulator_host}:{self.file_server_port}/data/{Path(parquet_file).name}"
+    
+    def file_is_served(self, parquet_file: str) -> bool:
+        """Check the file server serves the parquet file."""
+        file_server_url = self._file_server_url(parquet_file)
+        print(f"Checking file accessibility at: {file_server_url}")
+        try:
+            file_check = self.session.head(file_server_url)
+            if file_check.status_code == 200:
+                print(f"File is accessible (size: {file_check.headers.get('content-length', 'unknown')} bytes)")
+                return True
+            print(f"Warning: File check returned status {file_check.status_code}")
+        except Exception as e:
+            print(f"Warning: Could not check file accessibility: {e}")
+        return False
+    
     def create_regular_table_with_data(self, parquet_file: str, table_name: str) -> Tuple[str, List[Tuple[str, str]]]:
         """Create regular table and load data from parquet file."""
         print(f"Creating regular table {table_name} and loading data from {parquet_file}")
@@ -141,29 +328,8 @@ class BigQueryEmulatorExternalTable:
         except Exception as e:
             raise Exception(f"Failed to generate schema: {e}")
         
-        # Read parquet data
-        import pandas as pd
-        try:
-            df = pd.read_parquet(parquet_file)
-            print(f"Loaded {len(df)} rows from parquet file")
-            
-            # Filter columns to only include valid ones
-            valid_columns = [name for name, _ in column_tuples]
-            df_filtered = df[valid_columns]
-            print(f"Using {len(valid_columns)} valid columns: {valid_columns}")
-            
-        except Exception as e:
-            raise Exception(f"Failed to read parquet file: {e}")
-        
         # Create table schema for BigQuery API
-        fields = []
-        for name, datatype in column_tuples:
-            field = {
-                "name": name,
-                "type": datatype,
-                "mode": "NULLABLE"
-            }
-            fields.append(field)
+        fields = _fields_from_tuples(column_tuples)
         
         # Regular table configuration
         table_data = {
@@ -181,50 +347,134 @@ class BigQueryEmulatorExternalTable:
         
         # Create the table
         url = f"{self.base_url}/bigquery/v2/projects/{self.project_id}/datasets/{self.dataset_id}/tables"
-        response = requests.post(url, json=table_data)
+        response = self._post_json(url, table_data)
         
         if response.status_code == 200:
             print(f"Regular table {table_name} created successfully")
             
-            # Load data into the table
-            self._load_data_to_table(table_name, df_filtered)
+            # Load data into the table with a single load job; fall back to
+            # streaming inserts if the emulator rejects or fails the job. Any
+            # other error (e.g. a poll timeout) is raised, since a WRITE_TRUNCATE
+            # job that is still running could wipe the streamed rows later
+            try:
+                self._load_data_to_table(table_name, self._file_server_url(parquet_file), fields)
+            except LoadJobFailed as e:
+                print(f"Warning: Load job failed ({e}), falling back to streaming inserts")
+                valid_columns = [name for name, _ in column_tuples]
+                batches = self._iter_parquet_batches(parquet_file, valid_columns)
+                _run_sync(self._stream_data_to_table(table_name, batches))
             
             return table_name, column_tuples
         else:
             raise Exception(f"Failed to create regular table: {response.status_code} - {response.text}")
     
-    def _load_data_to_table(self, table_name: str, df: 'pd.DataFrame'):
-        """Load data from DataFrame into BigQuery table."""
-        print(f"Loading {len(df)} rows into table {table_name}...")
-        
-        # Convert DataFrame to BigQuery insert format
-        rows = []
-        for _, row in df.iterrows():
-            row_data = {}
-            for col, value in row.items():
-                # Handle NaN/None values
-                if pd.isna(value):
-                    row_data[col] = None
-                else:
-                    row_data[col] = str(value)  # Convert all to string for simplicity
-            rows.append({"json": row_data})
-        
-        # Insert data
-        insert_data = {
-            "rows": rows
+    def _iter_parquet_batches(self, parquet_file: str, valid_columns: List[str],
+                              batch_size: int = READ_BATCH_SIZE) -> Iterator['pa.RecordBatch']:
+        """Lazily read only the valid columns of a parquet file, one record batch at a time."""
+        try:
+            parquet = pq.ParquetFile(parquet_file)
+            print(f"Streaming {parquet.metadata.num_rows} rows from parquet file")
+            print(f"Using {len(valid_columns)} valid columns: {valid_columns}")
+            
+            # Project the columns at read time so skipped columns are never decoded
+            return parquet.iter_batches(batch_size=batch_size, columns=valid_columns)
+            
+        except Exception as e:
+            raise Exception(f"Failed to read parquet file: {e}")
+    
+    def _load_data_to_table(self, table_name: str, source_uri: str, fields: List[Dict],
+                            poll_interval: float = 0.5, timeout: float = 300):
+        """Load a parquet file into BigQuery table with a single load job."""
+        print(f"Loading {source_uri} into table {table_name} with a load job...")
+        
+        job_body = {
+            "configuration": {
+                "load": {
+                    "sourceUris": [source_uri],
+                    "sourceFormat": "PARQUET",
+                    "destinationTable": {
+                        "projectId": self.project_id,
+                        "datasetId": self.dataset_id,
+                        "tableId": table_name
+                    },
+                    "writeDisposition": "WRITE_TRUNCATE",
+                    "schema": {
+                        "fields": fields
+                    }
+                }
+            }
         }
         
+        url = f"{self.base_url}/bigquery/v2/projects/{self.project_id}/jobs"
+        response = self._post_json(url, job_body)
+        
+        if response.status_code != 200:
+            raise LoadJobFailed(f"Failed to submit load job: {response.status_code} - {response.text}")
+        
+        job = _json_loads(response)
+        job_id = job['jobReference']['jobId']
+        
+        # Poll the job until it is done
+        deadline = time.monotonic() + timeout
+        while job.get('status', {}).get('state') != 'DONE':
+            if time.monotonic() > deadline:
+                raise Exception(f"Load job {job_id} did not finish within {timeout}s")
+            time.sleep(poll_interval)
+            
+            response = self.session.get(f"{url}/{job_id}")
+            if response.status_code != 200:
+                raise Exception(f"Failed to get load job status: {response.status_code} - {response.text}")
+            job = _json_loads(response)
+        
+        error = job['status'].get('errorResult')
+        if error:
+            raise LoadJobFailed(f"Load job {job_id} failed: {error.get('message', error)}")
+        
+        output_rows = job.get('statistics', {}).get('load', {}).get('outputRows', 'unknown')
+        print(f"Data loaded successfully ({output_rows} rows)")
+    
+    async def _stream_data_to_table(self, table_name: str, batches: Iterable['pa.RecordBatch'],
+                                    batch_size: int = BATCH_SIZE, concurrency: int = CONCURRENCY):
+        """Stream record batches into BigQuery table with insertAll."""
+        print(f"Loading rows into table {table_name}...")
+        
         url = f"{self.base_url}/bigquery/v2/projects/{self.project_id}/datasets/{self.dataset_id}/tables/{table_name}/insertAll"
-        response = requests.post(url, json=insert_data)
+        insert_errors = []
+        total_rows = 0
+        
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Only one record batch is held in memory at a time
+            for batch in batches:
+                # Convert to BigQuery insert format, nulls are already None
+                rows = [{"json": record} for record in batch.to_pylist()]
+                
+                # Insert data in chunks to stay well below the insertAll request limits,
+                # posting up to `concurrency` chunks at a time
+                chunk_starts = range(0, len(rows), batch_size)
+                results = await asyncio.gather(*[
+                    self._insert_chunk(session, url, rows[start:start + batch_size])
+                    for start in chunk_starts
+                ])
+                
+                # Error indexes are relative to the chunk, make them relative to the whole load
+                for start, result in zip(chunk_starts, results):
+                    for error in result.get('insertErrors', []):
+                        insert_errors.append({**error, 'index': total_rows + start + error.get('index', 0)})
+                
+                total_rows += len(rows)
         
-        if response.status_code == 200:
-            result = response.json()
-            if 'insertErrors' in result:
-                print(f"Warning: Insert had errors: {result['insertErrors']}")
-            else:
-                print(f"Data loaded successfully ({len(rows)} rows)")
+        if insert_errors:
+            print(f"Warning: Insert had errors: {insert_errors}")
         else:
-            raise Exception(f"Failed to load data: {response.status_code} - {response.text}")
+            print(f"Data loaded successfully ({total_rows} rows)")
+    
+    async def _insert_chunk(self, session: 'aiohttp.ClientSession', url: str, rows: List[Dict]) -> Dict:
+        """Post a single chunk of rows to the insertAll endpoint."""
+        async with session.post(url, data=_json_dumps({"rows": rows}), headers=JSON_HEADERS) as response:
+            if response.status != 200:
+                raise Exception(f"Failed to load data: {response.status} - {await response.text()}")
+            return orjson.loads(await response.read())
 
     def create_external_table(self, parquet_file: str, table_name: str) -> Tuple[str, List[Tuple[str, str]]]:
         """Create external table from parquet file."""
@@ -238,28 +488,14 @@ class BigQueryEmulatorExternalTable:
         
         # Build the external table definition
         parquet_filename = Path(parquet_file).name
-        file_server_url = f"http://{self.emulator_host}:{self.file_server_port}/data/{parquet_filename}"
+        file_server_url = self._file_server_url(parquet_file)
         
         # Debug: Check if file is accessible
-        print(f"Checking file accessibility at: {file_server_url}")
-        try:
-            file_check = requests.head(file_server_url)
-            if file_check.status_code == 200:
-                print(f"File is accessible (size: {file_check.headers.get('content-length', 'unknown')} bytes)")
-            else:
-                print(f"Warning: File check returned status {file_check.status_code}")
-        except Exception as e:
-            print(f"Warning: Could not check file accessibility: {e}")
+        if self.verify_files:
+            self.file_is_served(parquet_file)
         
         # Create table schema for BigQuery API
-        fields = []
-        for name, datatype in column_tuples:
-            field = {
-                "name": name,
-                "type": datatype,
-                "mode": "NULLABLE"
-            }
-            fields.append(field)
+        fields = _fields_from_tuples(column_tuples)
         
         # External table configuration
         table_data = {
@@ -282,7 +518,7 @@ class BigQueryEmulatorExternalTable:
         
         # Create the table
         url = f"{self.base_url}/bigquery/v2/projects/{self.project_id}/datasets/{self.dataset_id}/tables"
-        response = requests.post(url, json=table_data)
+        response = self._post_json(url, table_data)
         
         if response.status_code == 200:
             print(f"External table {table_name} created successfully")
@@ -290,39 +526,80 @@ class BigQueryEmulatorExternalTable:
         else:
             raise Exception(f"Failed to create external table: {response.status_code} - {response.text}")
     
-    def query_table(self, table_name: str, limit: int = 10) -> Dict:
-        """Query the external table and return results."""
+    def query_table(self, table_name: str, limit: Optional[int] = 10, page_size: int = PAGE_SIZE) -> Dict:
+        """Query the table and return up to `limit` rows (all rows if None)."""
         print(f"Querying table {table_name}...")
         
+        # Only fetch as many pages as are needed to fill the limit
+        if limit is not None:
+            page_size = max(1, min(limit, page_size))
+        
+        result = {'schema': {}, 'rows': []}
+        for page in self.iter_query_pages(table_name, page_size):
+            if 'schema' in page:
+                result['schema'] = page['schema']
+            if 'totalRows' in page:
+                result['totalRows'] = page['totalRows']
+            result['rows'].extend(page.get('rows', []))
+            if limit is not None and len(result['rows']) >= limit:
+                del result['rows'][limit:]
+                break
+        
+        print(f"Query successful! Retrieved {len(result['rows'])} rows")
+        return result
+    
+    def iter_query_pages(self, table_name: str, page_size: int = PAGE_SIZE) -> Iterator[Dict]:
+        """Query the table and lazily yield result pages, following pageToken."""
         query = f"""
         SELECT *
         FROM `{self.project_id}.{self.dataset_id}.{table_name}`
-        LIMIT {limit}
         """
         
         query_data = {
             "query": query,
             "useLegacySql": False,
-            "location": "US"
+            "location": "US",
+            "maxResults": page_size
         }
         
         url = f"{self.base_url}/bigquery/v2/projects/{self.project_id}/queries"
-        response = requests.post(url, json=query_data)
+        response = self._post_json(url, query_data)
         
-        if response.status_code == 200:
-            result = response.json()
-            print(f"Query successful! Retrieved {len(result.get('rows', []))} rows")
-            return result
-        else:
+        if response.status_code != 200:
             raise Exception(f"Query failed: {response.status_code} - {response.text}")
+        
+        page = _json_loads(response)
+        yield page
+        
+        # Keep fetching while the job is still running or more pages remain
+        job_reference = page['jobReference']
+        while page.get('pageToken') or not page.get('jobComplete', True):
+            params = {
+                "maxResults": page_size,
+                "location": job_reference.get('location', 'US')
+            }
+            if page.get('pageToken'):
+                params["pageToken"] = page['pageToken']
+            
+            response = self.session.get(f"{url}/{job_reference['jobId']}", params=params)
+            
+            if response.status_code != 200:
+                raise Exception(f"Failed to get query results: {response.status_code} - {response.text}")
+            
+            page = _json_loads(response)
+            yield page
     
     def get_table_info(self, table_name: str) -> Dict:
         """Get information about the table."""
         url = f"{self.base_url}/bigquery/v2/projects/{self.project_id}/datasets/{self.dataset_id}/tables/{table_name}"
-        response = requests.get(url)
+        if url in self._response_cache:
+            return self._response_cache[url]
+        
+        response = self.session.get(url)
         
         if response.status_code == 200:
-            return response.json()
+            self._response_cache[url] = _json_loads(response)
+            return self._response_cache[url]
         else:
             raise Exception(f"Failed to get table info: {response.status_code} - {response.text}")
     
@@ -331,7 +608,8 @@ class BigQueryEmulatorExternalTable:
         print(f"Cleaning up table {table_name}...")
         
         url = f"{self.base_url}/bigquery/v2/projects/{self.project_id}/datasets/{self.dataset_id}/tables/{table_name}"
-        response = requests.delete(url)
+        self._response_cache.pop(url, None)
+        response = self.session.delete(url)
         
         if response.status_code == 204:
             print(f"Table {table_name} deleted successfully")
@@ -349,83 +627,120 @@ def print_query_results(result: Dict):
     schema = result.get('schema', {}).get('fields', [])
     column_names = [field['name'] for field in schema]
     
-    print()
-    print("QUERY RESULTS:")
-    print("=" * 60)
-    
-    # Print header
-    header = " | ".join(f"{name:<15}" for name in column_names)
-    print(header)
-    print("-" * len(header))
+    # One format string for every line instead of formatting cell by cell, wide
+    # enough for the schema and for every row (missing cells are left blank)
+    ncols = max([len(column_names)] + [len(row.get('f', [])) for row in result['rows']])
+    fmt = " | ".join(["{:<15}"] * ncols)
+    blanks = [''] * ncols
+    header = fmt.format(*column_names, *blanks)
     
-    # Print rows
+    lines = ["", "QUERY RESULTS:", "=" * 60, header, "-" * len(header)]
     for row in result['rows']:
-        values = []
-        for cell in row.get('f', []):
-            value = cell.get('v', 'NULL')
-            if value is None:
-                value = 'NULL'
-            values.append(f"{str(value):<15}")
-        print(" | ".join(values))
+        values = [cell.get('v', 'NULL') for cell in row.get('f', [])]
+        lines.append(fmt.format(*['NULL' if value is None else str(value) for value in values], *blanks))
+    lines.append("")
     
-    print()
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Create external table in BigQuery emulator and query data",
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="""
-Examples:
-    python3 bigquery_emulator_external_table.py ../data/sample_data_clean.parquet
-    python3 bigquery_emulator_external_table.py ../data/sample_data_problematic.parquet --table my_data
-        """
-    )
+def _read_cached_mode(base_url: str) -> Optional[str]:
+    """Get the table mode previously probed for this endpoint, if any."""
+    try:
+        return json.loads(MODE_CACHE_FILE.read_text()).get(base_url)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cached_mode(base_url: str, mode: str):
+    """Remember the probed table mode for this endpoint."""
+    print(f"Caching {mode} table mode for {base_url} in {MODE_CACHE_FILE}")
+    try:
+        cache = json.loads(MODE_CACHE_FILE.read_text())
+    except (OSError, ValueError):
+        cache = {}
+    cache[base_url] = mode
+    try:
+        MODE_CACHE_FILE.write_text(json.dumps(cache, indent=2))
+    except OSError as e:
+        print(f"Warning: Could not cache table mode: {e}")
+
+
+def run(parquet_file: str,
+        table: str = 'external_data',
+        limit: int = 10,
+        mode: str = 'regular',
+        use_regular_table: bool = False,
+        keep_running: bool = False,
+        verify_file: bool = False,
+        refresh: bool = False,
+        emulator: Optional[BigQueryEmulatorExternalTable] = None) -> Dict:
+    """
+    Create a table from a parquet file in the BigQuery emulator and query it.
     
-    parser.add_argument('parquet_file', help='Path to the parquet file')
-    parser.add_argument('--table', '-t', default='external_data', help='Name of the table to create')
-    parser.add_argument('--limit', '-l', type=int, default=10, help='Number of rows to query')
-    parser.add_argument('--keep-running', action='store_true', help='Keep services running after completion')
-    parser.add_argument('--use-regular-table', action='store_true', help='Create regular table instead of external table')
+    With mode='auto', a table mode cached for the endpoint is used unless
+    `refresh` is set, in which case the endpoint is probed again.
     
-    args = parser.parse_args()
+    Pass an existing `emulator` (with keep_running=True) to reuse its running
+    services and keep-alive session across runs; otherwise a new one is created
+    and its services started.
     
+    Returns:
+        Query result with 'schema' and 'rows'
+    """
     # Check if parquet file exists
-    parquet_path = Path(args.parquet_file)
-    if not parquet_path.exists():
-        print(f"ERROR: Parquet file not found: {args.parquet_file}")
-        sys.exit(1)
+    if not Path(parquet_file).exists():
+        raise FileNotFoundError(f"Parquet file not found: {parquet_file}")
     
     # Initialize the external table manager
-    emulator = BigQueryEmulatorExternalTable()
+    start_services = emulator is None
+    if emulator is None:
+        emulator = BigQueryEmulatorExternalTable(verify_files=verify_file)
     
     try:
         print("BIGQUERY EXTERNAL TABLE DEMO")
         print("=" * 60)
         
         # Start services
-        emulator.start_services()
+        if start_services:
+            emulator.start_services()
         
         # Ensure dataset exists
         emulator.ensure_dataset_exists()
         
-        # Create table (external or regular based on argument)
-        if args.use_regular_table:
+        # Create table (external or regular based on mode)
+        if use_regular_table:
+            mode = 'regular'
+        if mode == 'auto' and not refresh:
+            mode = _read_cached_mode(emulator.base_url) or 'auto'
+            if mode != 'auto':
+                print(f"Using cached {mode} table mode for {emulator.base_url} from {MODE_CACHE_FILE} "
+                      f"(--refresh to probe again)")
+        
+        if mode == 'regular':
             print("Creating regular table with data loading...")
-            table_name, column_tuples = emulator.create_regular_table_with_data(args.parquet_file, args.table)
+            table_name, column_tuples = emulator.create_regular_table_with_data(parquet_file, table)
         else:
             print("Creating external table...")
-            table_name, column_tuples = emulator.create_external_table(args.parquet_file, args.table)
-            
+            table_name, column_tuples = emulator.create_external_table(parquet_file, table)
+        
+        if mode == 'auto':
             # If external table returns no data, try regular table
             result = emulator.query_table(table_name, 1)  # Just check if we get any data
-            if not result.get('rows'):
+            if result.get('rows'):
+                _write_cached_mode(emulator.base_url, 'external')
+            else:
+                # An empty probe only shows external parquet is unsupported if the
+                # file has rows and the file server is actually serving it
+                if pq.read_metadata(parquet_file).num_rows > 0 and emulator.file_is_served(parquet_file):
+                    _write_cached_mode(emulator.base_url, 'regular')
+                else:
+                    print("Warning: Not caching the table mode, the parquet file is empty or not served yet")
                 print()
                 print("External table returned no data. Trying regular table approach...")
                 # Delete the external table first
                 emulator.cleanup_table(table_name)
                 # Create regular table
-                table_name, column_tuples = emulator.create_regular_table_with_data(args.parquet_file, args.table)
+                table_name, column_tuples = emulator.create_regular_table_with_data(parquet_file, table)
         
         # Get table information
         table_info = emulator.get_table_info(table_name)
@@ -439,7 +754,7 @@ Examples:
         print(f"Columns: {len(column_tuples)}")
         
         # Query the table
-        result = emulator.query_table(table_name, args.limit)
+        result = emulator.query_table(table_name, limit)
         print_query_results(result)
         
         # Show column information
@@ -451,7 +766,7 @@ Examples:
         print()
         print("SUCCESS: External table created and queried successfully!")
         
-        if not args.keep_running:
+        if not keep_running:
             # Cleanup
             emulator.cleanup_table(table_name)
             emulator.stop_services()
@@ -460,12 +775,54 @@ Examples:
             print("Services are still running. You can manually query the table:")
             print(f"Table: {emulator.project_id}.{emulator.dataset_id}.{table_name}")
             print(f"BigQuery endpoint: http://{emulator.emulator_host}:{emulator.emulator_port}")
-            print("To stop services: docker compose down")
+            print("To stop services: docker rm -f bigquery-emulator file-server")
         
+        return result
+        
+    except Exception:
+        if not keep_running:
+            emulator.stop_services()
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create external table in BigQuery emulator and query data",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+    python3 bigquery_emulator_external_table.py ../data/sample_data_clean.parquet
+    python3 bigquery_emulator_external_table.py ../data/sample_data_problematic.parquet --table my_data
+    python3 bigquery_emulator_external_table.py ../data/sample_data_clean.parquet --mode auto
+        """
+    )
+    
+    parser.add_argument('parquet_file', help='Path to the parquet file')
+    parser.add_argument('--table', '-t', default='external_data', help='Name of the table to create')
+    parser.add_argument('--limit', '-l', type=int, default=10, help='Number of rows to query')
+    parser.add_argument('--keep-running', action='store_true', help='Keep services running after completion')
+    parser.add_argument('--mode', '-m', choices=['external', 'regular', 'auto'], default='regular',
+                        help='Table to create: regular (default, the emulator cannot read external parquet), '
+                             'external (real BigQuery), or auto (probe once and cache the result)')
+    parser.add_argument('--refresh', action='store_true',
+                        help=f'With --mode auto, ignore the mode cached in {MODE_CACHE_FILE} and probe again')
+    parser.add_argument('--use-regular-table', action='store_true', help='Shortcut for --mode regular')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show per-column schema details')
+    parser.add_argument('--verify-file', action='store_true',
+                        help='Check the file server serves the parquet file before creating an external table')
+    
+    options = vars(parser.parse_args())
+    verbose = options.pop('verbose')
+    
+    # Only the schema generator gets DEBUG, not urllib3, asyncio or docker
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if verbose:
+        logging.getLogger("parquet_to_bq_schema").setLevel(logging.DEBUG)
+    
+    try:
+        run(**options)
     except Exception as e:
         print(f"ERROR: {e}")
-        if not args.keep_running:
-            emulator.stop_services()
         sys.exit(1)
 
 
@@ -9,11 +9,44 @@ Usage:
     python3 parquet_to_bq_schema.py <parquet_file_path>
 """
 
+import logging
+import re
 from typing import Dict, List, Tuple
 
 import pyarrow as pa
 import pyarrow.parquet as pq
 
+logger = logging.getLogger(__name__)
+
+# Letter or underscore followed by letters, numbers and underscores, at most 300 chars
+_COLUMN_NAME_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]{0,299}')
+
+# BigQuery specific restricted column name prefixes (compared upper-cased)
+_RESTRICTED_PREFIXES = (
+    '_PARTITION',
+    '_TABLE_',
+    '_FILE_',
+    '_ROW_TIMESTAMP',
+    '__ROOT__',
+    '_COLIDENTIFIER'
+)
+
+# BigQuery type for each non-nested PyArrow type id
+_BIGQUERY_TYPES_BY_ARROW_ID = {
+    pa.timestamp('us').id: 'TIMESTAMP',
+    pa.time32('s').id: 'TIME',
+    pa.time64('us').id: 'TIME',
+    pa.date32().id: 'DATE',
+    pa.date64().id: 'DATE',
+    **{t.id: 'INTEGER' for t in (pa.int8(), pa.int16(), pa.int32(), pa.int64(),
+                                 pa.uint8(), pa.uint16(), pa.uint32(), pa.uint64())},
+    **{t.id: 'FLOAT' for t in (pa.float16(), pa.float32(), pa.float64())},
+    pa.bool_().id: 'BOOLEAN',
+    pa.string().id: 'STRING',
+    pa.binary().id: 'BYTES',
+    pa.struct([]).id: 'RECORD',
+}
+
 
 class BigQuerySchemaGenerator:
     """Generate BigQuery schema from Parquet files with column validation."""
@@ -39,63 +72,37 @@ class BigQuerySchemaGenerator:
 
         # Check for BigQuery specific restricted prefixes (case-insensitive)
         column_name_upper = column_name.upper()
-        restricted_prefixes = [
-            '_PARTITION',
-            '_TABLE_',
-            '_FILE_',
-            '_ROW_TIMESTAMP',
-            '__ROOT__',
-            '_COLIDENTIFIER'
-        ]
-
-        for prefix in restricted_prefixes:
-            if column_name_upper.startswith(prefix):
-                return False, f"Column name starts with restricted prefix '{prefix}'"
-
-        # Check if starts with letter or underscore
-        if not (column_name[0].isalpha() or column_name[0] == '_'):
-            return False, "Column name must start with letter or underscore"
-
-        # Check if contains only valid characters (letters, numbers, underscores)
-        if not all(c.isalnum() or c == '_' for c in column_name):
+        if column_name_upper.startswith(_RESTRICTED_PREFIXES):
+            prefix = next(p for p in _RESTRICTED_PREFIXES if column_name_upper.startswith(p))
+            return False, f"Column name starts with restricted prefix '{prefix}'"
+
+        # Check if starts with letter or underscore and contains only letters, numbers, underscores
+        if not _COLUMN_NAME_RE.fullmatch(column_name):
+            if not (column_name[0].isalpha() or column_name[0] == '_'):
+                return False, "Column name must start with letter or underscore"
             return False, "Column name contains invalid characters"
 
         return True, ""
 
     def get_bigquery_type(self, arrow_type) -> str:
         """Convert PyArrow type to BigQuery type."""
-        # Handle timestamp types with different units
-        if pa.types.is_timestamp(arrow_type):
-            return 'TIMESTAMP'
-        elif pa.types.is_time(arrow_type):
-            return 'TIME'
-        elif pa.types.is_date(arrow_type):
-            return 'DATE'
-        elif pa.types.is_integer(arrow_type):
-            return 'INTEGER'
-        elif pa.types.is_floating(arrow_type):
-            return 'FLOAT'
-        elif pa.types.is_boolean(arrow_type):
-            return 'BOOLEAN'
-        elif pa.types.is_string(arrow_type) or pa.types.is_unicode(arrow_type):
-            return 'STRING'
-        elif pa.types.is_binary(arrow_type):
-            return 'BYTES'
-        elif pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
+        # Plain types (including every timestamp unit) map directly by type id
+        bq_type = _BIGQUERY_TYPES_BY_ARROW_ID.get(arrow_type.id)
+        if bq_type:
+            return bq_type
+
+        if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
             # For arrays, we need to determine the element type
             element_type = self.get_bigquery_type(arrow_type.value_type)
             return f'ARRAY<{element_type}>'
-        elif pa.types.is_struct(arrow_type):
-            return 'RECORD'
-        else:
-            # Default to STRING for unknown types
-            return 'STRING'
+
+        # Default to STRING for unknown types
+        return 'STRING'
 
     def read_parquet_schema(self, parquet_file: str) -> pa.Schema:
-        """Read schema from parquet file."""
+        """Read schema from parquet file footer without decoding any data."""
         try:
-            table = pq.read_table(parquet_file)
-            return table.schema
+            return pq.read_metadata(parquet_file).schema.to_arrow_schema()
         except Exception as e:
             raise Exception(f"Error reading parquet file {parquet_file}: {e}")
 
@@ -120,13 +127,15 @@ class BigQuerySchemaGenerator:
         print(f"Processing {len(arrow_schema.names)} columns...")
         print()
 
-        for field in arrow_schema:
-            column_name = field.name
-            arrow_type = field.type
-
-            # Check if column name is valid
-            is_valid, reason = self.is_valid_column_name(column_name)
+        # Validate every column in one pass over the schema's names, types and nullability
+        columns = [
+            (column_name, arrow_type, nullable, *self.is_valid_column_name(column_name))
+            for column_name, arrow_type, nullable in zip(
+                arrow_schema.names, arrow_schema.types, [field.nullable for field in arrow_schema]
+            )
+        ]
 
+        for column_name, arrow_type, nullable, is_valid, reason in columns:
             if not is_valid:
                 print(f"SKIPPING column '{column_name}': {reason}")
                 self.skipped_columns.append({
@@ -140,7 +149,7 @@ class BigQuerySchemaGenerator:
             bq_type = self.get_bigquery_type(arrow_type)
 
             # Determine mode (nullable vs required)
-            mode = 'NULLABLE' if field.nullable else 'REQUIRED'
+            mode = 'NULLABLE' if nullable else 'REQUIRED'
 
             field_def = {
                 'name': column_name,
@@ -151,7 +160,7 @@ class BigQuerySchemaGenerator:
             bq_schema.append(field_def)
             self.valid_columns.append(column_name)
 
-            print(f"OK {column_name:<30} -> {bq_type:<15} ({mode})")
+            logger.debug("OK %-30s -> %-15s (%s)", column_name, bq_type, mode)
 
         return bq_schema
 
@@ -233,6 +242,9 @@ def generate_bigquery_schema_from_parquet(parquet_file: str, table_name: str = "
 
 
 if __name__ == "__main__":
+    # Per-column OK lines are logged at DEBUG, raise the level to see them
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     ddl_statement, column_tuples = generate_bigquery_schema_from_parquet(
         # "/Users/nagaaravindb/rs/bigquery-external-table-poc/data/sample_data_problematic.parquet"
         "../data/nspolicy.parquet"